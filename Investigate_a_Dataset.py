@@ -45,6 +45,9 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 import matplotlib.pyplot as plt
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
 get_ipython().run_line_magic('matplotlib', 'inline')
 
 
@@ -56,8 +59,60 @@ get_ipython().run_line_magic('matplotlib', 'inline')
 # In[132]:
 
 
-gun = pd.read_csv('gun_data.csv')
+SNAPSHOT_DIR = 'nics_snapshots'
+snapshot_paths = sorted(glob.glob(os.path.join(SNAPSHOT_DIR, '*.csv')) +
+                        glob.glob(os.path.join(SNAPSHOT_DIR, '*.csv.gz')))
+
+
+# The NICS export is also archived as monthly snapshots, some of them gzip-compressed. If the snapshot folder is present, the Gun dataset is built from every snapshot instead of the single gun_data.csv file. The snapshot file names are dated, so sorting them puts the oldest snapshot first and the latest snapshot last.
+
+# In[ ]:
+
+
+def load_snapshots(paths):
+    key = ['month', 'state']
+    with ProcessPoolExecutor() as pool:
+        frames = list(pool.map(pd.read_csv, paths))
+    columns = list(frames[-1].columns)
+    shared = [c for c in columns if all(c in frame.columns for frame in frames)]
+    for rank, frame in enumerate(frames):
+        frame['snapshot'] = os.path.basename(paths[rank])
+        frame['snapshot_rank'] = rank
+    combined = pd.concat(frames, ignore_index=True)
+    revisions = combined.drop_duplicates(subset=shared)
+    conflicts = revisions[revisions.duplicated(subset=key, keep=False)].sort_values(key+['snapshot_rank'])
+    latest = combined.sort_values('snapshot_rank', kind='stable').drop_duplicates(subset=key, keep='last')
+    # gun_data.csv lists the newest month first and the states alphabetically within each month
+    latest = latest.sort_values(['month', 'state'], ascending=[False, True]).reset_index(drop=True)
+    return latest[columns], conflicts.drop(columns='snapshot_rank')
+
+
+# The snapshots are decompressed and parsed at the same time in a pool of worker processes, one file per core. The rows are then deduplicated on the natural key of month and state with a hashed drop_duplicates, keeping the row from the latest snapshot. A key that appears with different values in different snapshots is a conflicting revision, and these rows are kept aside to be reported.
+
+# In[ ]:
+
+
+if snapshot_paths:
+    gun, conflicts = load_snapshots(snapshot_paths)
+else:
+    gun = pd.read_csv('gun_data.csv')
+    conflicts = pd.DataFrame()
 census = pd.read_csv('census_data.csv')
+
+
+# In[ ]:
+
+
+if snapshot_paths:
+    print(len(snapshot_paths), 'snapshots loaded')
+    display(conflicts)
+
+
+# When the snapshots are used, each conflicting revision is listed with the snapshot it came from. The value from the latest snapshot is the one kept in the Gun dataset.
+
+# In[ ]:
+
+
 gun.head()
 
 
@@ -439,35 +494,47 @@ census.head()
 # 
 # ### Research Question 1: How many firearm background checks are performed by each ethnicity within the U.S.?
 
-# In[174]:
+# In[175]:
 
 
-bg_checks_mean = int(gun['totals'].mean())
-bg_checks_mean
+def estimate_group_checks(proportions, checks):
+    return proportions.T.dot(checks)
 
 
-# A variable has been created for the average total of Firearm Background Checks performed per state per month.
+# The estimator takes a states by groups matrix of census proportions and a states by time periods matrix of background checks. The census proportions are shares of each state's population, so the checks of every state and time period are split between the groups by that state's own population mix, and the splits are added up over the states. A single matrix product of the two matrices does this for every group and every time period at once, so states with more checks count for more instead of every state counting equally as in a plain mean.
+
+# In[ ]:
+
+
+census_states = census.set_index('state')
+monthly_checks = gun.pivot_table(index='state', columns=['year', 'month_no'], values='totals', aggfunc='sum', fill_value=0)
+monthly_checks.columns = ['%d-%02d' % c for c in monthly_checks.columns]
+yearly_checks = monthly_checks.T.groupby(lambda m: m[:4]).sum().T
+checks = pd.concat([monthly_checks, yearly_checks], axis=1)
+groups = census_states.columns.drop(['population_estimates', 'persons_in_poverty'])
+states = checks.index.intersection(census_states.index)
+group_checks = estimate_group_checks(census_states.loc[states, groups], checks.loc[states])
+group_checks
 
-# In[175]:
 
+# The background checks were pivoted into one column per month, and the yearly totals were added as extra columns, so the months and years are estimated in the same matrix product. Every ethnicity and education level in the Census Data is a row of the result.
 
-african = census['black_or_african_american_alone'].mean()*bg_checks_mean
-asian = census['asian_alone'].mean()*bg_checks_mean
-hawaiian = census['native_hawaiian_and_other_pacific_islander_alone'].mean()*bg_checks_mean
-hispanic = census['hispanic_or_latino'].mean()*bg_checks_mean
-native_a = census['american_indian_and_alaska_native_alone'].mean()*bg_checks_mean
-two_plus = census['two_or_more_races'].mean()*bg_checks_mean
-white = census['white_alone_mean'].mean()*bg_checks_mean
+# In[ ]:
 
 
-# The variables were created by multiplying the mean proportion of each ethnicity for all states by the mean number of background checks performed per state per month in the U.S.
+group_means = group_checks[monthly_checks.columns].mean(axis=1)/len(states)
+group_means
+
+
+# The national estimates were averaged over all months and divided by the number of states to give the average background checks per group per state per month in the U.S., which is what the charts below show.
 
 # In[176]:
 
 
 plt.subplots(figsize=(8, 5))
 locations = [1, 2, 3, 4, 5, 6, 7]
-heights = [african, asian, hawaiian, hispanic, native_a, two_plus, white]
+heights = group_means[['black_or_african_american_alone', 'asian_alone', 'native_hawaiian_and_other_pacific_islander_alone',
+                       'hispanic_or_latino', 'american_indian_and_alaska_native_alone', 'two_or_more_races', 'white_alone_mean']]
 labels = ['African', 'Asian', 'Hawaiian', 'Hispanic', 'Native Indian/Alaskan', 'Multi Racial', 'Caucasion']
 plt.bar(locations, heights, tick_label=labels)
 plt.xticks(rotation=90)
@@ -480,20 +547,13 @@ plt.ylabel('Background Checks');
 
 # ### Research Question 2:  How many firearm background checks are performed per education level within the U.S.?
 
-# In[177]:
-
-
-diploma = census['high_school_graduate_or_higher'].mean()*bg_checks_mean
-bachelors = census["bachelor's_degree_or_higher"].mean()*bg_checks_mean
-
-
-# The variables were created by multiplying the mean proportion of each degree for all states by the mean number of background checks performed per state per month in the U.S.
+# The education levels were estimated in the same matrix product as the ethnicities, so their averages are already in group_means.
 
 # In[178]:
 
 
 locations = [1, 2]
-heights = [diploma, bachelors]
+heights = group_means[['high_school_graduate_or_higher', "bachelor's_degree_or_higher"]]
 labels = ['High School Diploma', "Bachelor's Degree"]
 plt.bar(locations, heights, tick_label=labels)
 #plt.xticks(rotation=90)
@@ -558,40 +618,89 @@ merged.sort_values(by=['totals', 'persons_in_poverty'], ascending=False).head()
 
 # ### Research Question 4: Which states have the highest growth of firearm background checks within the data time period?
 
-# In[184]:
-
-
-years_sum = gun.groupby(['state', 'year'])['totals'].sum().reset_index()
-years_sum.head()
-
-
-# The monthly background checks were summed to get the total for each year.
-
 # In[185]:
 
 
-checks_99 = years_sum.query('year == 1999')
-checks_16 = years_sum.query('year == 2016')
-
-
-# The years 1999 and 2016 were filtered used because they had complete monthly data.
+class CheckRangeIndex:
+    def __init__(self, frame):
+        self.first = (frame['year']*12 + frame['month_no'] - 1).min()
+        self.columns = pd.Index(['U.S.'])
+        self.cumulative = np.zeros((256, 1))
+        self.size = 1
+        self.append(frame)
+
+    def append(self, frame):
+        monthly = frame.assign(ordinal=frame['year']*12 + frame['month_no'] - 1).pivot_table(
+            index='ordinal', columns='state', values='totals', aggfunc='sum')
+        if monthly.empty:
+            return
+        next_ordinal = self.first + self.size - 1
+        revision = monthly.index.min() == next_ordinal - 1 and self.size > 1
+        if monthly.index.min() < next_ordinal and not revision:
+            raise ValueError('Only the last indexed month or later months can be appended')
+        new_states = monthly.columns.difference(self.columns)
+        if len(new_states):
+            self.columns = self.columns.append(new_states)
+            self.cumulative = np.hstack([self.cumulative, np.zeros((len(self.cumulative), len(new_states)))])
+        monthly = monthly.reindex(columns=self.columns[1:])
+        if revision:
+            # A revised last month replaces the indexed values of the states it contains and keeps the others
+            previous = self.cumulative[self.size - 1, 1:] - self.cumulative[self.size - 2, 1:]
+            monthly.loc[next_ordinal - 1] = monthly.loc[next_ordinal - 1].fillna(pd.Series(previous, index=self.columns[1:]))
+            self.size -= 1
+            next_ordinal -= 1
+        monthly = monthly.reindex(index=range(next_ordinal, monthly.index.max() + 1)).fillna(0)
+        monthly = monthly.to_numpy(dtype=float)
+        monthly = np.column_stack([monthly.sum(axis=1), monthly])
+        # The buffer doubles when it is full, so appending months does not copy the whole index every time
+        end = self.size + len(monthly)
+        if end > len(self.cumulative):
+            grown = np.zeros((max(end, 2*len(self.cumulative)), len(self.columns)))
+            grown[:self.size] = self.cumulative[:self.size]
+            self.cumulative = grown
+        self.cumulative[self.size:end] = self.cumulative[self.size - 1] + monthly.cumsum(axis=0)
+        self.size = end
+
+    def _bounds(self, start, end):
+        starts = pd.PeriodIndex(np.atleast_1d(start), freq='M')
+        ends = pd.PeriodIndex(np.atleast_1d(end), freq='M')
+        lower = np.asarray(starts.year*12 + starts.month - 1) - self.first
+        upper = np.asarray(ends.year*12 + ends.month - 1) - self.first + 1
+        valid = (lower >= 0) & (upper <= self.size - 1) & (lower < upper)
+        return np.where(valid, lower, 0), np.where(valid, upper, 0), valid
+
+    def total(self, states, start, end):
+        columns = self.columns.get_indexer(np.atleast_1d(states))
+        if (columns < 0).any():
+            raise KeyError('Unknown state in range query')
+        lower, upper, valid = self._bounds(start, end)
+        try:
+            np.broadcast_shapes(columns.shape, lower.shape)
+        except ValueError:
+            raise ValueError('States and ranges must have the same length, or one of them must be a single value')
+        totals = self.cumulative[upper, columns] - self.cumulative[lower, columns]
+        return np.where(valid, totals, np.nan)
+
+    def mean(self, states, start, end):
+        lower, upper, valid = self._bounds(start, end)
+        return self.total(states, start, end)/np.where(valid, upper - lower, 1)
+
+    def difference(self, states, start, end, other_start, other_end):
+        return self.total(states, other_start, other_end) - self.total(states, start, end)
+
+
+# A cumulative sum index was built over each state's monthly background checks, with an extra 'U.S.' column for the national series. The total of any range of months is the cumulative sum at the end of the range minus the cumulative sum before its start, so every total, average or difference takes the same time no matter how long the range is. Ranges that end before they start or reach outside the indexed months give NaN instead of a partial total. The states and months can be given as arrays to answer thousands of ranges in one call. The arrays are matched pair by pair, so they must have the same length, and a single state or month is used for every pair. New months, including months for states that were not indexed before, can be added with append without rebuilding the index. The last indexed month can also be appended again to replace it with a revised snapshot, but earlier months cannot be revised without building a new index.
 
 # In[186]:
 
 
-diff = (checks_16.set_index('state')-checks_99.set_index('state')).dropna(axis=0)
+range_index = CheckRangeIndex(gun)
+diff = pd.DataFrame({'state': gun_states.index,
+                     'totals': range_index.difference(gun_states.index, '1999-01', '1999-12', '2016-01', '2016-12')})
 diff.head()
 
 
-# The difference was achieved by subtracting the 1999 data from the 2016 data.
-
-# In[187]:
-
-
-diff = diff.reset_index(drop = False)
-
-
-# The index numbers were reset after previous queries.
+# The years 1999 and 2016 were used because they had complete monthly data. The difference was achieved by subtracting the 1999 total from the 2016 total for every state in one call to the range index.
 
 # In[188]:
 
@@ -605,7 +714,7 @@ top_five
 # In[189]:
 
 
-top_five = top_five.iloc[0:5, [0, 2]]
+top_five = top_five.iloc[0:5, [0, 1]]
 top_five
 
 
@@ -642,11 +751,13 @@ plt.ylabel('Background Checks');
 # In[192]:
 
 
-time_years = years_sum.iloc[1:19, :].groupby('year')['totals'].sum().reset_index()
+years = np.arange(1999, 2017)
+time_years = pd.DataFrame({'year': years,
+                           'totals': range_index.total('U.S.', [f'{y}-01' for y in years], [f'{y}-12' for y in years])})
 time_years.head()
 
 
-# Filtered the years to include only years that had complete monthly data.
+# The national totals were taken from the range index for the years that had complete monthly data.
 
 # In[193]:
 
@@ -670,16 +781,26 @@ plt.locator_params(nbins=11)
 
 # A chart of average number of background checks per year.
 
+# In[ ]:
+
+
+fiscal_years = np.arange(2000, 2018)
+fiscal_totals = range_index.total('U.S.', [f'{y-1}-10' for y in fiscal_years], [f'{y}-09' for y in fiscal_years])
+pd.DataFrame({'fiscal_year': fiscal_years, 'totals': fiscal_totals})
+
+
+# The range index also gives the national totals for custom ranges such as the federal fiscal years, which run from October to September, without grouping the Gun dataset again. Fiscal year 1999 began in October 1998, before the data starts, so it is left out.
+
 # <a id='conclusions'></a>
 # ## Conclusions
 # 
 # How many firearm background checks are performed by each ethnicity within the U.S.?
 # 
-# The chart shows that caucasion americans produce the most firearm background checks of all ethnicities in the United States at approximately 17,500 checks per month per state. However, this implies that all ethnicities undergo firearm background checks in the same proportions that they are present in the United States. This assumption may lead to innacurate results in the analysis. Some ethnicities may be more prone to private gun sales over public, or vice versa.
+# The chart shows that caucasion americans produce the most firearm background checks of all ethnicities in the United States. However, this implies that all ethnicities undergo firearm background checks in the same proportions that they are present in the United States. This assumption may lead to innacurate results in the analysis. Some ethnicities may be more prone to private gun sales over public, or vice versa.
 # 
 # How many firearm background checks are performed by different education levels in the U.S.?
 # 
-# The chart shows that people with high school diplomas produce more firearm background checks than those holding a Bachelor's Degree, with approximately 21,000 checks per month per state. Again, this implies that the different education levels undergo gun background checks in the same proportions that they are present in the United States. This is a limitation in the analysis.  
+# The chart shows that people with high school diplomas produce more firearm background checks than those holding a Bachelor's Degree. Again, this implies that the different education levels undergo gun background checks in the same proportions that they are present in the United States. This is a limitation in the analysis.  
 # 
 # Is there a correlation between firearm background checks compared to the percentage of people in poverty?
 # 
@@ -693,7 +814,7 @@ plt.locator_params(nbins=11)
 # 
 # What is the overall trend of gun background checks thoughout the data time period?
 # 
-# The number of firearm background checks remained relatively unchanged between 1999 and 2007. The year 2007 saw a jump in background checks, but decreased slightly in 2010. There was a signigicant spike in background checks between 2010 and 2015, which increased from approximately 300000 per year to over 700000 per year. More research is needed to speculate the reason behind the increased firearm background checks within those years.
+# The number of firearm background checks remained relatively unchanged between 1999 and 2007. The year 2007 saw a jump in background checks, but decreased slightly in 2010. There was a signigicant spike in background checks between 2010 and 2015. More research is needed to speculate the reason behind the increased firearm background checks within those years.
 
 # In[195]:
 